@@ -23,62 +23,91 @@
 # BSD license, all text above must be included in any redistribution.
 
 import atexit
+from collections import namedtuple
 import _pickle as pickle
 import errno
-import fnmatch
 import io
 import os
 import os.path
-from picamera2 import Picamera2
+from picamera2 import MappedArray, Picamera2
 import pygame
+import numpy as np
 import stat
+import struct
 import threading
-import time
+import weakref
 import cv2
 from pygame.locals import *
 from subprocess import call
 import queue
 import math
+import simplejpeg
 from enum import Enum
-from libcamera import controls
+from libcamera import Transform, controls
 
 
-def fitBlit(rect, bitmap, screen, smooth=False):
-    if bitmap is None:
-        return
-
-    scaledWidth = bitmap.get_width() / rect[2]
-    scaledHeight = bitmap.get_height() / rect[3]
-    scaleFactor = max(scaledWidth, scaledHeight)
-    if smooth:
-        transformed = pygame.transform.smoothscale(bitmap, (int(
-            bitmap.get_width() / scaleFactor), int(bitmap.get_height() / scaleFactor)))
+def fitGeometry(rect, size, fill=False):
+    # Scale size to fit (or fill) rect, keeping the aspect ratio.
+    # Returns the scaled (w, h) and the (x, y) that centers it in rect.
+    scaledWidth = size[0] / rect[2]
+    scaledHeight = size[1] / rect[3]
+    if fill:
+        scaleFactor = min(scaledWidth, scaledHeight)
     else:
-        transformed = pygame.transform.scale(bitmap, (int(
-            bitmap.get_width() / scaleFactor), int(bitmap.get_height() / scaleFactor)))
+        scaleFactor = max(scaledWidth, scaledHeight)
+    return ((int(size[0] / scaleFactor), int(size[1] / scaleFactor)),
+            (int(rect[0] + (rect[2] - size[0] / scaleFactor) / 2),
+             int(rect[1] + (rect[3] - size[1] / scaleFactor) / 2)))
+
+
+def scaleSurface(bitmap, size, smooth=False):
+    # Exact 2x and 4x enlargements can use scale2x, which is much cheaper
+    # than a filtered scale
+    w, h = bitmap.get_size()
+    if size == (w * 2, h * 2):
+        return pygame.transform.scale2x(bitmap)
+    if size == (w * 4, h * 4):
+        return pygame.transform.scale2x(pygame.transform.scale2x(bitmap))
+    if smooth:
+        return pygame.transform.smoothscale(bitmap, size)
+    return pygame.transform.scale(bitmap, size)
 
-    screen.blit(transformed,
-                (int(rect[0] + (rect[2] - bitmap.get_width() / scaleFactor) / 2),
-                 int(rect[1] + (rect[3] - bitmap.get_height() / scaleFactor) / 2)))
 
+def hidden(rect, screen):
+    # True if nothing drawn in rect could end up on screen
+    cr = screen.get_clip()
+    return (rect[2] <= 0 or rect[3] <= 0 or
+            rect[0] + rect[2] <= cr.x or rect[1] + rect[3] <= cr.y or
+            rect[0] >= cr.right or rect[1] >= cr.bottom)
 
-def fillBlit(rect, bitmap, screen, smooth=False):
-    if bitmap is None:
+
+# Scaled copies of plain Surfaces (playback thumbnails), so showing the same
+# image again is a blit rather than another smoothscale.  Entries go away
+# along with the Surface they were made from.
+scaledCache = weakref.WeakKeyDictionary()  # Surface: {(w, h, smooth): copy}
+
+
+def scaledBlit(rect, bitmap, screen, smooth, fill):
+    if bitmap is None or hidden(rect, screen):
         return
 
-    scaledWidth = bitmap.get_width() / rect[2]
-    scaledHeight = bitmap.get_height() / rect[3]
-    scaleFactor = min(scaledWidth, scaledHeight)
-    if smooth:
-        transformed = pygame.transform.smoothscale(bitmap, (int(
-            bitmap.get_width() / scaleFactor), int(bitmap.get_height() / scaleFactor)))
-    else:
-        transformed = pygame.transform.scale(bitmap, (int(
-            bitmap.get_width() / scaleFactor), int(bitmap.get_height() / scaleFactor)))
+    size, pos = fitGeometry(rect, bitmap.get_size(), fill)
+    cache = scaledCache.setdefault(bitmap, {})
+    key = (size[0], size[1], smooth)
+    transformed = cache.get(key)
+    if transformed is None:
+        transformed = scaleSurface(bitmap, size, smooth)
+        cache[key] = transformed
+
+    screen.blit(transformed, pos)
+
+
+def fitBlit(rect, bitmap, screen, smooth=False):
+    scaledBlit(rect, bitmap, screen, smooth, False)
 
-    screen.blit(transformed,
-                (int(rect[0] + (rect[2] - bitmap.get_width() / scaleFactor) / 2),
-                 int(rect[1] + (rect[3] - bitmap.get_height() / scaleFactor) / 2)))
+
+def fillBlit(rect, bitmap, screen, smooth=False):
+    scaledBlit(rect, bitmap, screen, smooth, True)
 
 
 # UI classes ---------------------------------------------------------------
@@ -97,10 +126,22 @@ class Icon:
 
     def __init__(self, name):
         self.name = name
+        self.bitmap = None
+        self._cache = {}  # Scaled copies of bitmap, keyed by (w, h, smooth)
         try:
-            self.bitmap = pygame.image.load(iconPath + '/' + name + '.png')
-        except BaseException:
-            pass
+            # Convert to the display's pixel format once, not on every blit
+            self.bitmap = pygame.image.load(
+                iconPath + '/' + name + '.png').convert_alpha()
+        except (pygame.error, OSError) as e:
+            print("Could not load icon", name, e)
+
+    def get_scaled(self, w, h, smooth=False):
+        key = (w, h, smooth)
+        scaled = self._cache.get(key)
+        if scaled is None:
+            scaled = scaleSurface(self.bitmap, (w, h), smooth)
+            self._cache[key] = scaled
+        return scaled
 
 # Button is a simple tappable screen region.  Each has:
 #  - bounding rect ((X,Y,W,H) in pixels)
@@ -122,10 +163,10 @@ class Icon:
 class Button:
 
     def __init__(self, rect, **kwargs):
-        self.rect = rect  # Bounds
-        self.color = None  # Background fill color, if any
         self.iconBg = None  # Background Icon (atop color fill)
         self.iconFg = None  # Foreground Icon (atop background)
+        self.rect = rect  # Bounds (see setter below)
+        self.color = None  # Background fill color, if any
         self.bg = None  # Background Icon name
         self.fg = None  # Foreground Icon name
         self.callback = None  # Callback function
@@ -142,37 +183,54 @@ class Button:
             elif key == 'value':
                 self.value = value
 
-    def selected(self, pos):
-        x1 = self.rect[0]
-        y1 = self.rect[1]
-        x2 = x1 + self.rect[2] - 1
-        y2 = y1 + self.rect[3] - 1
-        if ((pos[0] >= x1) and (pos[0] <= x2) and
-                (pos[1] >= y1) and (pos[1] <= y2)):
-            if self.callback:
-                if self.value is None:
-                    self.callback()
-                else:
-                    self.callback(self.value)
-            return True
-        return False
+    # Inclusive hit-test bounds are worked out whenever rect is assigned,
+    # rather than on every tap; so are the scaled icons and their positions
+    @property
+    def rect(self):
+        return self._rect
+
+    @rect.setter
+    def rect(self, rect):
+        self._rect = rect
+        self._x1 = rect[0]
+        self._y1 = rect[1]
+        self._x2 = rect[0] + rect[2] - 1
+        self._y2 = rect[1] + rect[3] - 1
+        self._rescale()
+
+    def press(self):
+        if self.callback:
+            if self.value is None:
+                self.callback()
+            else:
+                self.callback(self.value)
 
     def draw(self, screen):
         if self.color:
             screen.fill(self.color, self.rect)
-        if self.iconBg:
-            fitBlit(self.rect, self.iconBg.bitmap, screen)
-        if self.iconFg:
-            fitBlit(self.rect, self.iconFg.bitmap, screen)
+        for bitmap, pos in self._pairs:
+            screen.blit(bitmap, pos)
+        return self.rect  # Dirty rect for pygame.display.update()
+
+    def blitPairs(self):
+        # (Surface, position) pairs for Surface.blits(), background first
+        return self._pairs
 
     def setBg(self, name):
-        if name is None:
-            self.iconBg = None
-        else:
-            for i in icons:
-                if name == i.name:
-                    self.iconBg = i
-                    break
+        self.iconBg = None if name is None else iconByName.get(name)
+        self._rescale()
+
+    # Fit the icons to rect now, so drawing is only blits.  Must be called
+    # again after assigning iconBg/iconFg directly.  Also marks the cached
+    # screen overlays stale (see renderScreen).
+    def _rescale(self):
+        global buttonsChanged
+        buttonsChanged += 1
+        self._pairs = []
+        for icon in (self.iconBg, self.iconFg):
+            if icon and icon.bitmap:
+                size, pos = fitGeometry(self.rect, icon.bitmap.get_size())
+                self._pairs.append((icon.get_scaled(size[0], size[1]), pos))
 
 
 class Screen(Enum):
@@ -241,14 +299,13 @@ def viewCallback(n):  # Viewfinder buttons
     if n == 0:   # Gear icon (settings)
         screenMode = Screen(settingMode)  # Switch to last settings mode
     elif n == 1:  # Play icon (image playback)
-        if scaled:  # Last photo is already memory-resident
-            loadIdx = saveIdx
+        if scaled:  # Last photo is already memory-resident (loadIdx is set)
             screenMode = Screen.VIEW  # Image playback
             screenModePrior = Screen.REFRESH  # Force screen refresh
         else:      # Load image
-            r = imgRange(pathData[storeMode])
-            if r:
-                showImage(r[1])  # Show last image in directory
+            r = imgMax(pathData[storeMode])
+            if r is not None:
+                showImage(r)  # Show last image in directory
             else:
                 screenMode = Screen.NO_IMG  # No images
     else:  # Rest of screen = shutter
@@ -277,47 +334,90 @@ def zoomModeCallback():
 screen = None  # Ugly hack to get the image viewer to load well
 
 
-def spinner():
-    global busy, screenMode, screenModePrior, screen
+# The spinner is animated from the main loop by a pygame timer rather
+# than by a thread drawing on its own, since SDL isn't thread-safe.
+# Slow work (image loads, captures) goes to a worker thread via runBusy(),
+# which posts SPINNER_DONE back to the main loop once it's finished.
+SPINNER_EVENT = pygame.USEREVENT + 1  # Advance the spinner animation
+SPINNER_DONE = pygame.USEREVENT + 2   # runBusy() job has finished
+busy = False           # True while a runBusy() job is in progress
+spinnerFrame = 0       # Current 'work-N' icon
+spinnerButtons = None  # ('Working' label, spinner) Buttons in use
+SPINNER_DELAY = 50     # ms a runBusy() job may take before the spinner shows
+
 
+# Input is blocked straight away, but with a delay the spinner is only drawn
+# once that much time has passed; quick jobs finish first and never flash it.
+def startSpinner(delay=0):
+    global busy, spinnerButtons, spinnerFrame
+
+    busy = True
     # screen is not ready
     if not screen:
         return
-    buttons.get(screenMode)[3].setBg('working')
-    buttons.get(screenMode)[3].draw(screen)
-    pygame.display.update()
+    sb = screenButtons.get(screenMode)
+    if sb.working is None:  # Nowhere to show it; just block input
+        return
+    spinnerButtons = (sb.working, sb.spinner)
+    spinnerFrame = -1  # Not shown yet
+    if delay:
+        pygame.time.set_timer(SPINNER_EVENT, delay, loops=1)
+    else:
+        spinnerTick()
 
-    busy = True
-    n = 0
-    while busy is True:
-        buttons.get(screenMode)[4].setBg('work-' + str(n))
-        buttons.get(screenMode)[4].draw(screen)
-        pygame.display.update()
-        n = (n + 1) % 5
-        time.sleep(0.15)
-
-    buttons.get(screenMode)[3].setBg(None)
-    buttons.get(screenMode)[4].setBg(None)
+
+def spinnerTick():
+    global spinnerFrame
+
+    if not busy or not spinnerButtons:
+        return
+    if spinnerFrame < 0:  # First tick puts the spinner up
+        spinnerButtons[0].setBg('working')
+        pygame.time.set_timer(SPINNER_EVENT, 150)
+    spinnerFrame = (spinnerFrame + 1) % 5
+    spinnerButtons[1].setBg('work-' + str(spinnerFrame))
+    # Only the spinner changes; don't push the whole framebuffer
+    pygame.display.update([b.draw(screen) for b in spinnerButtons])
+
+
+def stopSpinner():
+    global busy, screenModePrior, spinnerButtons
+
+    busy = False
+    pygame.time.set_timer(SPINNER_EVENT, 0)
+    if spinnerButtons:
+        for b in spinnerButtons:
+            b.setBg(None)
+        spinnerButtons = None
     screenModePrior = Screen.REFRESH  # Force refresh
 
 
-def imgRange(path):
-    min = 9999
-    max = 0
-    try:
-        for file in os.listdir(path):
-            if fnmatch.fnmatch(file, 'IMG_[0-9][0-9][0-9][0-9].JPG'):
-                i = int(file[4:8])
-                if (i < min):
-                    min = i
-                if (i > max):
-                    max = i
-    finally:
-        return None if min > max else (min, max)
+# Run work() on the busy worker thread with the spinner going.  done(result)
+# is then called from the main loop; result is None if work() failed.
+# One long-lived thread takes the jobs, rather than a new thread per shot;
+# input is ignored while busy, so there's never more than one queued.
+busyQueue = queue.Queue()
+
+
+def runBusy(work, done=None):
+    startSpinner(SPINNER_DELAY)
+    busyQueue.put((work, done))
+
+
+def busyWorker():
+    while True:
+        work, done = busyQueue.get()
+        result = None
+        try:
+            result = work()
+        except Exception as e:
+            print(e)
+        pygame.event.post(pygame.event.Event(SPINNER_DONE, done=done,
+                                             result=result))
 
 
 def showNextImage(direction):
-    global busy, loadIdx
+    global loadIdx
 
     try:
         n = loadIdx
@@ -327,34 +427,63 @@ def showNextImage(direction):
                 n = 0
             elif (n < 0):
                 n = 9999
-            if os.path.exists(pathData[storeMode] + '/IMG_' + '%04d' % n + '.JPG'):
+            if os.path.exists(filenameTemplates[storeMode] % n):
                 showImage(n)
                 break
     except Exception as e:
             print(e)
 
 def showImage(n):
-    global busy, loadIdx, scaled, screenMode, screenModePrior, sizeMode, storeMode
-
-    filename = pathData[storeMode] + '/IMG_' + '%04d' % n + '.JPG'
+    filename = filenameTemplates[storeMode] % n
     print(filename)
     #cache thumbnail
     if filename in thumbnails:
-        try:
-            print("Getting from cache")
-            scaled = thumbnails[filename]
-        except Exception as e:
-            print(e)
+        print("Getting from cache")
+        imageLoaded(n, thumbnails[filename])
     else:
-        t = threading.Thread(target=spinner)
-        t.start()
         print("Getting from disk")
+        runBusy(lambda: loadThumbnail(filename),
+                lambda img: imageLoaded(n, img))
+
+
+def loadThumbnail(filename):  # Runs on a runBusy() worker thread
+    # Prefer the small .THM saved beside each shot; older photos (or ones
+    # copied in from elsewhere) fall back to decoding the full JPEG.
+    # pygame goes by extension, hence the name hint for the .THM.
+    try:
+        with open(thumbnailName(filename), 'rb') as f:
+            img = pygame.image.load(f, 'thumb.jpg')
+    except (pygame.error, OSError):
         img = pygame.image.load(filename)
-        scaled = pygame.transform.scale(img, sizeData[sizeMode][1])
-        thumbnails[filename] = scaled
-        busy = False
-        t.join()
+    # Filtered scaling for a shrink this big, and the display's pixel
+    # format up front so playback blits don't convert on the fly
+    if img.get_size() != sizeData[sizeMode][1]:
+        img = pygame.transform.smoothscale(img, sizeData[sizeMode][1])
+    scaled = orientThumbnail(img.convert())
+    thumbnails[filename] = scaled
+    return scaled
+
+
+def thumbnailName(filename):  # IMG_XXXX.JPG -> IMG_XXXX.THM, DCF style
+    return filename[:-4] + '.THM'
+
+
+# Thumbnails are turned to match the screen once, when they're made, so
+# playback can just blit them.  Rotation is always a multiple of 90, which
+# pygame does as a straight pixel shuffle rather than resampling.  Saved
+# photos aren't flipped by the ISP, so this is the full screen_rotation.
+def orientThumbnail(img):
+    if screen_rotation % 360:
+        img = pygame.transform.rotate(img, screen_rotation)
+    return img
 
+
+def imageLoaded(n, img):
+    global loadIdx, scaled, screenMode, screenModePrior
+
+    if img is None:  # Load failed
+        return
+    scaled = img
     print("get OK")
     loadIdx = n
 
@@ -380,11 +509,27 @@ def deleteCallback(n):  # Delete confirmation
     screenMode = Screen.VIEW
     screenModePrior = Screen.REFRESH
     if n is True:
-        os.remove(pathData[storeMode] + '/IMG_' + '%04d' % loadIdx + '.JPG')
-        if (imgRange(pathData[storeMode])):
-            screen.fill(0)
-            pygame.display.update()
+        filename = filenameTemplates[storeMode] % loadIdx
+        # The photo may have just been taken and still be queued for
+        # saving; let it land first, or the write would bring it back
+        saveQueue.join()
+        try:
+            os.remove(filename)
+        except OSError as e:
+            print(e)
+        try:
+            os.remove(thumbnailName(filename))
+        except OSError:
+            pass  # Older photos have no .THM
+        thumbnails.pop(filename, None)
+        imgMaxUpdate(pathData[storeMode], loadIdx, False)
+        if imgMax(pathData[storeMode]) is not None:
             showNextImage(-1)
+            # A cached image is fully redrawn next frame anyway; only if it
+            # has to load, blank the deleted one (before the spinner's up)
+            if busy:
+                screen.fill(0)
+                pygame.display.update()
         else:  # Last image deleteted; go to 'no images' mode
             screenMode = Screen.NO_IMG
             scaled = None
@@ -393,32 +538,88 @@ def deleteCallback(n):  # Delete confirmation
 
 def storeModeCallback(n):  # Radio buttons on storage settings screen
     global storeMode
-    buttons.get(Screen.SETTINGS_STORAGE)[storeMode + 3].setBg('radio3-0')
+    screenButtons[Screen.SETTINGS_STORAGE].radios[storeMode].setBg('radio3-0')
     storeMode += n
     storeMode %= len(sizeData)
-    buttons.get(Screen.SETTINGS_STORAGE)[storeMode + 3].setBg('radio3-1')
+    screenButtons[Screen.SETTINGS_STORAGE].radios[storeMode].setBg('radio3-1')
 
-# This is split into two methods since when loading the settings we just want to init button state, not apply settings
+# Only picks the size and moves the radio button; applySizeMode() below is
+# what reconfigures the camera
 def setSizeModeAndButtons(n):
     global sizeMode
     # Size mode should never be out of bounds, but it might be!
-    buttons.get(Screen.SETTINGS_SIZE)[sizeMode + 3].setBg('radio3-0')
+    screenButtons[Screen.SETTINGS_SIZE].radios[sizeMode].setBg('radio3-0')
     sizeMode = n
-    buttons.get(Screen.SETTINGS_SIZE)[sizeMode + 3].setBg('radio3-1')
-
-def setSizeMode(n):
-    setSizeModeAndButtons(n)
-    camera.still_configuration.main.size = sizeData[n][0]
-    camera.stop()
-    camera.configure("still")
-    camera.still_configuration.align()
-    camera.start()
+    screenButtons[Screen.SETTINGS_SIZE].radios[sizeMode].setBg('radio3-1')
+
+# Startup and size changes both configure the camera from this, so the
+# stream formats, buffer count and flip stay the same whatever the size.
+# A video configuration keeps the preview streaming at a usable frame
+# rate; stills are taken from the full-resolution main stream regardless.
+# Photos are black and white, so main is YUV420 and only its luma is kept.
+# The lores stream has to stay YUV420 (the Pi 4 and older ISP can't give it
+# RGB), but the viewfinder only reads its Y plane so nothing gets converted.
+def videoConfig():
+    main_config = {"size": sizeData[sizeMode][0], "format": "YUV420"}
+    lores_config = {"size": sizeData[sizeMode][1], "format": "YUV420"}
+    return camera.create_video_configuration(main_config, lores_config,
+                                             buffer_count=2,
+                                             transform=Transform(hflip=ispFlip, vflip=ispFlip))
+
+
+# Controls the app has set (greyscale, ISO, EV), kept so they can be
+# applied again after the camera is reconfigured.  Later settings of the
+# same control replace earlier ones, as they do on the camera.
+cameraControls = {}
+
+
+def setControls(**kw):
+    cameraControls.update(kw)
+    camera.set_controls(kw)
+
+
+# Picking a size only moves the radio button.  Reconfiguring the camera is
+# slow, so the main loop calls this right after the event that leaves the
+# size screen, rather than on every tap while cycling through the options.
+def applySizeMode():
+    global LORES_SIZE, scalerCropMaximum, analogueGainLimits, sizeModeApplied
+    if sizeMode == sizeModeApplied:
+        return
+    with cameraLock:  # Keep the viewfinder pipeline from capturing meanwhile
+        camera.stop()
+        camera.configure(videoConfig())
+        # configure() drops the controls set so far; put the app's back
+        camera.set_controls(cameraControls)
+        camera.start()
+        LORES_SIZE = tuple(camera.camera_config['lores']['size'])
+        # Frames still queued were framed for the old size; drop them
+        # rather than show them on the way back to the viewfinder
+        for q in (capQ, dispQ):
+            while True:
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    break
+    allocStillBuffer()
+    # The sensor mode, and so the crop and gain limits, can change with the size
+    scalerCropMaximum = None
+    analogueGainLimits = None
     setZoomMode(ZoomMode.NORMAL) #reset zoom
+    sizeModeApplied = sizeMode
+
+
+# Full-resolution stills are copied into one buffer that is reused for
+# every shot, rather than a fresh array per capture
+def allocStillBuffer():
+    global stillBuffer
+    w, h = camera.camera_config['main']['size']
+    if stillBuffer is None or stillBuffer.shape != (h, w):
+        stillBuffer = np.empty((h, w), dtype=np.uint8)
 
 
 def sizeModeCallback(n):  # Radio buttons on size settings screen
     global sizeMode
-    setSizeMode((sizeMode + n) % len(sizeData))
+    setSizeModeAndButtons((sizeMode + n) % len(sizeData))
 
 
 # Global stuff -------------------------------------------------------------
@@ -426,22 +627,32 @@ screenMode = Screen.VIEWFINDER      # Current screen mode; default = viewfinder
 screenModePrior = Screen.REFRESH      # Prior screen mode (for detecting changes)
 settingMode = 4      # Last-used settings mode (default = storage)
 storeMode = 0      # Storage mode; default = Photos folder
-storeModePrior = -1      # Prior storage mode (for detecting changes)
 sizeMode = 0      # Image size: default = Large
+sizeModeApplied = 0  # Size the camera is configured for (see applySizeMode)
 fxMode = 0      # Image effect: default = Normal
 analogueGain = 0      # ISO setting; default = Auto
 evMode = 0       # EV Compensation. Default: 0
 iconPath = 'icons'  # Subdirectory containing UI bitmaps (PNG format)
 saveIdx = -1      # Image index for saving (-1 = none set yet)
+saveIdxCache = {}  # Next index to save at, per storage path used so far
+saveIdxWrapped = set()  # Paths whose index wrapped past 9999 (may collide)
 loadIdx = -1      # Image index for loading
 scaled = None    # pygame Surface w/last-loaded image
 screen_height = 240     # TFT display height
 screen_width = 240     # TFT display width
 # counterclockwise rotation of your camera sensor from vertical (ribbon cable port pointing down)
 screen_rotation = 180
-imageQueue = queue.Queue()
+# The ISP can flip both axes for free, which takes care of 180 degrees of
+# the viewfinder.  Whatever is left over, 0 or 90 degrees, is still rotated
+# on the CPU.  Photos are saved sensor-side up as they always have been, so
+# existing ones still play back right: capturePicture undoes the flip.
+assert screen_rotation % 90 == 0, 'screen_rotation must be a multiple of 90'
+ispFlip = screen_rotation % 360 >= 180
+displayRotation = screen_rotation % 180
+unflip = np.s_[::-1, ::-1] if ispFlip else np.s_[:, :]
 zoom_mode = ZoomMode.NORMAL # By default digital zoom is not used
 thumbnails = {}
+stillBuffer = None  # Luma of the last still; see allocStillBuffer()
 
 sizeData = [  # Camera parameters for different size settings
     # Full res      Viewfinder
@@ -486,8 +697,12 @@ pathData = [
     '/home/pi/Photos',     # Path for storeMode = 0 (Photos folder)
     '/boot/DCIM/CANON999',  # Path for storeMode = 1 (Boot partition)
     '/home/pi/Photos']     # Path for storeMode = 2 (Dropbox)
+# Full image filename for each storeMode, formatted with the index
+filenameTemplates = [p + '/IMG_%04d.JPG' for p in pathData]
 
 icons = []  # This list gets populated at startup
+iconByName = {}  # Same Icons keyed by name, also populated at startup
+buttonsChanged = 0  # Bumped by Button._rescale(); see renderScreen()
 
 # buttons[] is a dict of lists; each top-level element corresponds
 # to one screen mode (e.g. viewfinder, image playback, storage settings),
@@ -501,13 +716,23 @@ icons = []  # This list gets populated at startup
 # The old camera project hardcoded these to fit 320x240
 
 
-def scaleHeight(height):
-    return int(height * screen_height / 240)
+# At the old project's native 320x240 these are just int().  Otherwise
+# the screen size is bound as a default argument, saving a global lookup
+# per call; the arithmetic is kept as is so rounding doesn't change.
+if screen_height == 240 and screen_width == 320:
+    scaleHeight = scaleWidth = int
+else:
+    def scaleHeight(height, _screen_height=screen_height):
+        return int(height * _screen_height / 240)
 
+    def scaleWidth(width, _screen_width=screen_width):
+        return int(width * _screen_width / 320)
 
-def scaleWidth(width):
-    return int(width * screen_width / 320)
 
+# Label icon and scaled indicator X position for each evData entry,
+# worked out once instead of on every setEvMode()
+evIcons = ['ev-' + str(ev[0]) for ev in evData]
+evIndicatorX = [scaleWidth(ev[1] - 10) for ev in evData]
 
 buttons = dict({
     # Screen mode 0 is photo playback
@@ -631,8 +856,89 @@ buttons = dict({
                         Button((0, scaleHeight(10), scaleWidth(320), scaleHeight(35)), bg='quit')]
 })
 
+# Hit-test bounds for each screen, one (x1, y1, x2, y2) row per Button, so
+# a tap is tested against every Button on the screen in one vectorized
+# compare.  Rebuild a screen's array if one of its Button rects changes.
+hitArrays = {}
+
+
+def updateHitArray(mode):
+    hitArrays[mode] = np.array([(b._x1, b._y1, b._x2, b._y2)
+                                for b in buttons.get(mode)], dtype=np.int32)
+
+
+for mode in buttons:
+    updateHitArray(mode)
+
+
+# Named handles on the Buttons that change at runtime, rather than
+# hand-counted indices into buttons[].  Unused fields are None.
+ScreenButtons = namedtuple('ScreenButtons',
+                           'working spinner radios label bar arrow',
+                           defaults=(None,) * 6)
+
+
+def screenButtonsFor(mode):
+    b = buttons.get(mode)
+    if mode in (Screen.VIEW, Screen.VIEWFINDER):
+        return ScreenButtons(working=b[3], spinner=b[4])
+    if mode in (Screen.SETTINGS_STORAGE, Screen.SETTINGS_SIZE):
+        return ScreenButtons(radios=tuple(b[3:6]))
+    if mode == Screen.SETTINGS_EFFECT:
+        return ScreenButtons(label=b[4])
+    if mode in (Screen.SETTINGS_ISO, Screen.SETTINGS_EV):
+        return ScreenButtons(label=b[5], bar=b[6], arrow=b[7])
+    return ScreenButtons()
+
+
+screenButtons = {mode: screenButtonsFor(mode) for mode in buttons}
+
+
+def screenTapped(pos):
+    # First (lowest) Button whose rect holds pos takes the tap
+    arr = hitArrays[screenMode]
+    hits = np.flatnonzero((arr[:, 0] <= pos[0]) & (pos[0] <= arr[:, 2]) &
+                          (arr[:, 1] <= pos[1]) & (pos[1] <= arr[:, 3]))
+    if len(hits):
+        buttons.get(screenMode)[hits[0]].press()
+
 # Assorted utility functions -----------------------------------------------
 
+# Draw every Button for a screen mode, returning their rects.  Color fills
+# go first, then all icons in a single blit call rather than one
+# screen.blit per icon.
+# The fills, blit pairs and rects for each mode are gathered once and kept
+# until some Button changes, so a frame doesn't walk the button list at all.
+# (Not prerendered to one screen-sized SRCALPHA overlay: alpha-blitting the
+# whole screen every frame would move far more pixels than the icons do.)
+overlayCache = {}  # mode: (buttonsChanged, fills, pairs, rects)
+
+
+def renderScreen(screen, mode):
+    cached = overlayCache.get(mode)
+    if cached is None or cached[0] != buttonsChanged:
+        fills = []
+        pairs = []
+        rects = []
+        for b in buttons.get(mode):
+            rects.append(b.rect)
+            if hidden(b.rect, screen):
+                continue
+            if b.color:
+                fills.append((b.color, b.rect))
+            pairs.extend(b.blitPairs())
+        cached = (buttonsChanged, fills, pairs, rects)
+        overlayCache[mode] = cached
+    _, fills, pairs, rects = cached
+    for color, rect in fills:
+        screen.fill(color, rect)
+    if hasattr(screen, 'fblits'):  # pygame-ce
+        screen.fblits(pairs)
+    else:
+        screen.blits(pairs, doreturn=False)
+    return rects
+
+
 # Doesn't do anything at the moment
 
 
@@ -640,14 +946,18 @@ def setFxMode(n):
     global fxMode
     fxMode = n
 # camera.image_effect = fxData[fxMode]
-    buttons.get(Screen.SETTINGS_EFFECT)[5].setBg('fx-' + fxData[fxMode])
+    screenButtons[Screen.SETTINGS_EFFECT].label.setBg('fx-' + fxData[fxMode])
+
+
+analogueGainLimits = None  # (min, max, default), read from camera once per size
 
 
 def setIsoMode(n):
-    global analogueGain
+    global analogueGain, analogueGainLimits
     try:
-        
-        (min_gain, max_gain, default_gain) = camera.camera_controls['AnalogueGain']
+        if analogueGainLimits is None:
+            analogueGainLimits = camera.camera_controls['AnalogueGain']
+        (min_gain, max_gain, default_gain) = analogueGainLimits
 
         # Make sure the gain is within limits
         n = max(min_gain, n)
@@ -655,15 +965,16 @@ def setIsoMode(n):
 
         # pycamera2 deals with analogue and digital gain, not ISO
 
-        camera.controls.AnalogueGain = n
-        analogueGain = n
         # Only works when auto exposure is off
-        camera.controls.AeEnable = False
+        setControls(AnalogueGain=n, AeEnable=False)
+        analogueGain = n
 
         # dynamically adjust indicator position as a percentage of the ISO bar
-        cursorWidth = buttons.get(Screen.SETTINGS_ISO)[7].rect[2]
-        indicatorPosition = int(n/(max_gain-min_gain) * buttons.get(Screen.SETTINGS_ISO)[6].rect[2] - cursorWidth * 2)
-        buttons.get(Screen.SETTINGS_ISO)[7].rect = ((cursorWidth + indicatorPosition,) + buttons.get(Screen.SETTINGS_ISO)[7].rect[1:])
+        sb = screenButtons[Screen.SETTINGS_ISO]
+        cursorWidth = sb.arrow.rect[2]
+        indicatorPosition = int(n/(max_gain-min_gain) * sb.bar.rect[2] - cursorWidth * 2)
+        sb.arrow.rect = ((cursorWidth + indicatorPosition,) + sb.arrow.rect[1:])
+        updateHitArray(Screen.SETTINGS_ISO)
 
     except:
         print("Could not change ISO mode")
@@ -674,19 +985,24 @@ def setEvMode(n):
     global evMode
     try:
         evMode = n
-        camera.controls.ExposureValue = evData[evMode][0]/2.0
         # Only seems to work when auto exposure is on
-        camera.controls.AeEnable = True
-        buttons.get(Screen.SETTINGS_EV)[5].setBg(
-            'ev-' + str(evData[evMode][0]))
-        buttons.get(Screen.SETTINGS_EV)[7].rect = ((scaleWidth(evData[evMode][1] - 10),) +
-                                                   buttons.get(Screen.SETTINGS_EV)[7].rect[1:])
+        setControls(ExposureValue=evData[evMode][0]/2.0, AeEnable=True)
+        sb = screenButtons[Screen.SETTINGS_EV]
+        sb.label.setBg(evIcons[evMode])
+        sb.arrow.rect = ((evIndicatorX[evMode],) + sb.arrow.rect[1:])
+        updateHitArray(Screen.SETTINGS_EV)
     except:
         print("Could not change EV Mode")
         # For some reason changes to the settings sometimes break with a key error!
 
+scalerCropMaximum = None  # Sensor crop limits, read from camera once per size
+
+
 def setZoomMode(mode):
-    (x_offset, y_offset, width, height) = camera.camera_properties['ScalerCropMaximum']
+    global scalerCropMaximum
+    if scalerCropMaximum is None:
+        scalerCropMaximum = camera.camera_properties['ScalerCropMaximum']
+    (x_offset, y_offset, width, height) = scalerCropMaximum
     zoom_factor = 4 # you can't tell if something is focused in 1:1 mapping, so let's scale
     factor_width = screen_width * zoom_factor
     factor_height = screen_height * zoom_factor
@@ -699,30 +1015,66 @@ def setZoomMode(mode):
         y_offset = 600
         camera.controls.ScalerCrop = (x_offset, y_offset, width, height)
     elif mode == ZoomMode.ZOOMED:
-        camera.controls.ScalerCrop = (int((width-factor_width)/2), int((height-factor_height)/2), factor_width, factor_height)
-
+        # Clamp in one go, so a sensor smaller than the zoomed window
+        # can't produce a negative or oversized crop
+        crop = np.clip(np.array([(width - factor_width) // 2, (height - factor_height) // 2,
+                                 factor_width, factor_height], dtype=np.int32),
+                       0, [width, height, width, height])
+        camera.controls.ScalerCrop = tuple(crop.tolist())
+
+# Settings are a few fixed fields, so they're packed into a tiny binary
+# file that fits in a single SD card sector rather than pickled.  If the
+# fields ever change, change the file name too; loadSettings() falls back
+# to the older pickle file when cam.bin is missing or the wrong size.
+settingsFile = 'cam.bin'
+settingsFormat = struct.Struct('<BfBBB')  # fx, iso (analogue gain), size, store, ev
+savedSettings = None  # Bytes last read from or written to settingsFile
+
+
+# Only touches the SD card if something actually changed.  The new file is
+# written beside the old one and renamed over it, so a power cut mid-write
+# leaves the previous settings intact rather than a truncated file.
 def saveSettings():
+    global savedSettings
+
+    data = settingsFormat.pack(fxMode, analogueGain, sizeMode, storeMode,
+                               evMode)
+    if data == savedSettings:
+        return
     try:
-        outfile = open('cam.pkl', 'wb')
-        # Use a dictionary (rather than pickling 'raw' values) so
-        # the number & order of things can change without breaking.
-        d = {'fx': fxMode,
-             'iso': analogueGain,
-             'size': sizeMode,
-             'store': storeMode,
-             'ev': evMode}
-        pickle.dump(d, outfile)
-        outfile.close()
+        tmp = settingsFile + '.tmp'
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_DSYNC, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        os.replace(tmp, settingsFile)
+        savedSettings = data
     except BaseException:
         pass
 
 
+def readSettings():
+    global savedSettings
+
+    try:
+        with open(settingsFile, 'rb') as infile:
+            data = infile.read()
+        if len(data) == settingsFormat.size:
+            savedSettings = data
+            return dict(zip(('fx', 'iso', 'size', 'store', 'ev'),
+                            settingsFormat.unpack(data)))
+    except OSError:
+        pass
+    # Settings saved by older versions
+    with open('cam.pkl', 'rb') as infile:
+        return pickle.load(infile)
+
+
 def loadSettings():
     global sizeMode
     try:
-        infile = open('cam.pkl', 'rb')
-        d = pickle.load(infile)
-        infile.close()
+        d = readSettings()
         if 'fx' in d:
             setFxMode(d['fx'])
         if 'iso' in d:
@@ -737,24 +1089,60 @@ def loadSettings():
         pass
 
 # Scan files in a directory, locating JPEGs with names matching the
-# software's convention (IMG_XXXX.JPG), returning a tuple with the
-# lowest and highest indices (or None if no matching files).
-def imgRange(path):
-    min = 9999
-    max = 0
+# software's convention (IMG_XXXX.JPG), returning the highest index
+# (or None if no matching files).  That's all any caller needs: new shots
+# go after it and playback starts from it.
+# Results are cached against the directory mtime, which changes whenever
+# a file is added or removed, so a repeat call costs a single stat().
+imgMaxCache = {}  # path: (directory mtime, max index or None)
+
+
+def imgMax(path):
     try:
-        for file in os.listdir(path):
-            if fnmatch.fnmatch(file, 'IMG_[0-9][0-9][0-9][0-9].JPG'):
-                i = int(file[4:8])
-                if (i < min):
-                    min = i
-                if (i > max):
-                    max = i
-    finally:
-        return None if min > max else (min, max)
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    cached = imgMaxCache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    max = -1
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                # Spelled out rather than a regex: a length check throws
+                # out nearly every other name before any slicing happens
+                name = entry.name
+                if (len(name) == 12 and name.startswith('IMG_') and
+                        name.endswith('.JPG') and name[4:8].isdecimal()):
+                    i = int(name[4:8])
+                    if (i > max):
+                        max = i
+    except OSError:
+        pass
+    r = None if max < 0 else max
+    imgMaxCache[path] = (mtime, r)
+    return r
+
+
+# Keep the cached max in step with our own saves and deletes, so the
+# next imgMax() doesn't have to rescan the directory.
+def imgMaxUpdate(path, n, added):
+    cached = imgMaxCache.pop(path, None)
+    if cached is None:
+        return
+    r = cached[1]
+    if added:
+        r = n if r is None else max(r, n)
+    elif r == n:
+        return  # Deleted the last image; leave it to a rescan
+    try:
+        imgMaxCache[path] = (os.stat(path).st_mtime_ns, r)
+    except OSError:
+        pass
 
 def takePicture():
-    global busy, gid, loadIdx, saveIdx, scaled, sizeMode, storeMode, storeModePrior, uid, screen_height, screen_width
+    global saveIdx, scaled
 
     if not os.path.isdir(pathData[storeMode]):
         try:
@@ -771,81 +1159,270 @@ def takePicture():
             return
 
     # If this is the first time accessing this directory,
-    # scan for the max index, start at next pos.
-    if storeMode != storeModePrior:
-        r = imgRange(pathData[storeMode])
+    # scan for the max index, start at next pos.  After that it's
+    # remembered, so switching storage modes back and forth never rescans.
+    path = pathData[storeMode]
+    if path in saveIdxCache:
+        saveIdx = saveIdxCache[path]
+    else:
+        r = imgMax(path)
         if r is None:
             saveIdx = 1
         else:
-            saveIdx = r[1] + 1
+            saveIdx = r + 1
             if saveIdx > 9999:
                 saveIdx = 0
-        storeModePrior = storeMode
+                saveIdxWrapped.add(path)
 
-    # Scan for next available image slot
-    while True:
-        filename = pathData[storeMode] + '/IMG_' + '%04d' % saveIdx + '.JPG'
-        if not os.path.isfile(filename):
-            break
-        saveIdx += 1
-        if saveIdx > 9999:
-            saveIdx = 0
-
-    t = threading.Thread(target=spinner)
-    t.start()
+    # Counting up from max+1, every slot is free by construction, so no
+    # stat() is needed.  Only once the index has wrapped round to the
+    # start can it run into older files; then probe onward for a free slot.
+    filename = filenameTemplates[storeMode] % saveIdx
+    if path in saveIdxWrapped:
+        while os.path.isfile(filename):
+            saveIdx = (saveIdx + 1) % 10000
+            filename = filenameTemplates[storeMode] % saveIdx
 
     scaled = None
+    runBusy(lambda: capturePicture(filename, path, saveIdx),
+            lambda thumb: pictureTaken(thumb, path))
+
+
+def capturePicture(filename, path, n):  # Runs on a runBusy() worker thread
+    # Errors (disk full, etc.) are reported by runBusy()
+    request = camera.capture_request()
+    # camera.capture_file(filename, format='jpeg')
+    # The main stream is YUV420, so the ISP has already done the colour
+    # to grey conversion: the photo is just the Y plane, copied back out of
+    # the ISP's flip in the same pass (see unflip).
+    w, h = request.config['main']['size']
+    with MappedArray(request, 'main') as m:
+        np.copyto(stillBuffer, m.array[:h, :w][unflip])
+    # The thumbnail comes from the lores stream, already at screen size; the
+    # full-size still never becomes a Surface.  Same trick as the main
+    # stream: its Y plane is all there is to show, with stride padding
+    # sliced off, so no colour conversion is needed.
+    w, h = LORES_SIZE
+    with MappedArray(request, 'lores') as m:
+        luma = m.array[:h, :w][unflip][:, :, np.newaxis].copy()
+    request.release()
+    print("Request released")
+
+    rgb = np.repeat(luma, 3, axis=2)
+    scaled = orientThumbnail(pygame.image.frombuffer(rgb, (w, h), 'RGB'))
+    thumbnails[filename] = scaled
+
+    # img.save(filename)
+    # simplejpeg (libjpeg-turbo's TurboJPEG API, with NEON on the Pi) is
+    # already installed as a picamera2 dependency.  Single-channel GRAY
+    # input skips any colour conversion or chroma planes.
+    jpeg = simplejpeg.encode_jpeg(stillBuffer[:, :, np.newaxis], quality=85,
+                                  colorspace='GRAY', colorsubsampling='Gray')
+    # Plus a screen-sized copy, so playback needn't decode the full photo
+    thumb = simplejpeg.encode_jpeg(luma, quality=85, colorspace='GRAY',
+                                   colorsubsampling='Gray')
+    print("Encode complete")
+    # The SD card write happens on saveWorker; the camera is free already
+    saveQueue.put((filename, path, n, jpeg, thumb))
+    return scaled
+
+
+# Encoded JPEGs are written out by their own thread, so a slow SD card
+# doesn't hold up the viewfinder or the next shot.  The queue is small;
+# in a burst of shots, capturePicture blocks on the busyWorker thread
+# (with the spinner up) rather than letting shots pile up in memory.
+# A None entry tells the thread to stop once everything before it is saved.
+saveQueue = queue.Queue(maxsize=2)
+
+
+def writeFile(filename, data):
+    # Set image file mode to 644
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                 stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
     try:
-        request = camera.capture_request()
-        # camera.capture_file(filename, format='jpeg')
-        array = request.make_array('main')
-        array_thumb = request.make_array('lores')
-        request.release()
-        print("Request released")
-       
-        rgb = cv2.cvtColor(array_thumb, cv2.COLOR_YUV420p2BGR)
-        # Dimensions of the output buffer might not be the same as the input. Surprise!
-        h, w, d = rgb.shape
-        scaled = pygame.image.frombuffer(rgb, (w, h), 'RGB')
-        thumbnails[filename] = scaled
-
-        img = cv2.cvtColor(array, cv2.COLOR_BGR2GRAY)
-        print("Transform complete")
-        # img.save(filename)
-        cv2.imwrite(filename, img, [cv2.IMWRITE_JPEG_QUALITY, 85])
-        print("Save complete")
-        # Set image file ownership to pi user, mode to 644
-        # os.chown(filename, uid, gid) # Not working, why?
-        os.chmod(filename, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+        data = memoryview(data).cast('B')
+        while data:
+            data = data[os.write(fd, data):]
     finally:
-        # Add error handling/indicator (disk full, etc.)
-        busy = False
-        t.join()
+        os.close(fd)
+    # Force the mode past any umask, and give the file to the pi user.
+    # This is on the save thread, so a filesystem that won't take it (the
+    # FAT boot partition refuses both) costs a log line and nothing else.
+    try:
+        os.chmod(filename, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+        os.chown(filename, uid, gid)
+    except OSError as e:
+        print("Could not set owner/mode of", filename, e)
+
 
-    pygame.display.update()
+# Files aren't fsync()ed one by one; instead the whole burst is flushed
+# with one sync() once the queue runs dry (or at exit), so the SD card sees
+# a few large writes rather than several small synchronous ones.
+def saveWorker():
+    while True:
+        item = saveQueue.get()
+        if item is None:
+            os.sync()
+            saveQueue.task_done()
+            break
+        filename, path, n, jpeg, thumb = item
+        try:
+            writeFile(filename, jpeg)
+            print("Save complete")
+            try:
+                writeFile(thumbnailName(filename), thumb)
+            except OSError as e:
+                print(e)  # Playback falls back to the full JPEG
+            # Only once both files are in, so the cached directory mtime
+            # is the final one and the next imgMax() needn't rescan
+            imgMaxUpdate(path, n, True)
+        except OSError as e:
+            # Add error handling/indicator (disk full, etc.)
+            print(e)
+        finally:
+            if saveQueue.empty():
+                os.sync()
+            saveQueue.task_done()
+
+
+def pictureTaken(thumb, path):  # runBusy() callback for capturePicture
+    global loadIdx, saveIdx, scaled
+
+    if thumb is None:  # Capture or encode failed
+        return
+    scaled = thumb
     loadIdx = saveIdx
+    # The file may not be on disk yet, so the slot scan in takePicture
+    # can't be relied on to skip it
+    saveIdx += 1
+    if saveIdx > 9999:
+        saveIdx = 0
+        saveIdxWrapped.add(path)
+    saveIdxCache[path] = saveIdx
+
+
+# Viewfinder pipeline ------------------------------------------------------
+# Preview frames pass through two worker threads so that capture,
+# conversion and display overlap instead of running back to back:
+#   captureWorker - copies the Y (luma) plane of each lores YUV420 frame
+#                   into a capture buffer -> capQ
+#   scaleWorker   - rotates and crops/scales it to the screen, expanding
+#                   grey to RGB, into a display buffer -> dispQ
+#   main loop     - blits the display buffer
+# Each stage cycles through a ring of preallocated buffers.  A ring of
+# (queue size + 2) is always safe to reuse: put() blocks while the queue
+# is full, so the next stage has moved on by the time a slot comes round
+# again.  The same backpressure idles the camera while the main loop
+# isn't showing the viewfinder.
+PIPELINE_DEPTH = 2
+capQ = queue.Queue(maxsize=PIPELINE_DEPTH)
+dispQ = queue.Queue(maxsize=PIPELINE_DEPTH)
+captureBuffers = [None] * (PIPELINE_DEPTH + 2)  # Sized on first frame
+displayBuffers = [np.empty((screen_height, screen_width, 3), dtype=np.uint8)
+                  for i in range(PIPELINE_DEPTH + 2)]
+# A Surface wrapping each display buffer, made once; scaleWorker writes the
+# pixels in place, so the main loop blits these without creating anything.
+displaySurfaces = [pygame.image.frombuffer(b, (screen_width, screen_height),
+                                           'RGB') for b in displayBuffers]
+cameraLock = threading.Lock()  # Held while capturing or reconfiguring
+
+rotateCodes = {90: cv2.ROTATE_90_COUNTERCLOCKWISE,  # Same sense as
+               180: cv2.ROTATE_180,                 # pygame.transform.rotate
+               270: cv2.ROTATE_90_CLOCKWISE}
+
+
+def fillCrop(img, size):
+    # Center crop of img with the aspect ratio of size, i.e. the part
+    # of img that fillBlit would show
+    h, w = img.shape[:2]
+    scaleFactor = min(w / size[0], h / size[1])
+    cw = int(size[0] * scaleFactor)
+    ch = int(size[1] * scaleFactor)
+    x = (w - cw) // 2
+    y = (h - ch) // 2
+    return img[y:y + ch, x:x + cw]
+
+
+def captureWorker():
+    n = 0
+    while True:
+        try:
+            # Held until the request is back, so a reconfigure can't
+            # change LORES_SIZE or the buffers under the copy
+            with cameraLock:
+                request = camera.capture_request()
+                try:
+                    # Photos are black and white anyway, so the preview only
+                    # needs the Y plane: the first h rows of the YUV420 buffer.
+                    # Rows may be padded out past the image width.  Surprise!
+                    w, h = LORES_SIZE
+                    with MappedArray(request, 'lores') as m:
+                        luma = m.array[:h, :w]
+                        if (captureBuffers[n] is None or
+                                captureBuffers[n].shape != luma.shape):
+                            captureBuffers[n] = np.empty_like(luma)
+                        np.copyto(captureBuffers[n], luma)
+                finally:
+                    request.release()
+        except Exception as e:
+            print(e)
+            continue
+        capQ.put(n)
+        n = (n + 1) % len(captureBuffers)
+
+
+def scaleWorker():
+    n = 0
+    rotateCode = rotateCodes.get(displayRotation)
+    if displayRotation:
+        size = (screen_height, screen_width)
+    else:
+        size = (screen_width, screen_height)
+    gray = np.empty((screen_height, screen_width), dtype=np.uint8)
+    rotated = np.empty((size[1], size[0]), dtype=np.uint8)
+    while True:
+        luma = captureBuffers[capQ.get()]
+        try:
+            if rotateCode is None:
+                cv2.resize(fillCrop(luma, size), size, dst=gray,
+                           interpolation=cv2.INTER_AREA)
+            else:
+                cv2.resize(fillCrop(luma, size), size, dst=rotated,
+                           interpolation=cv2.INTER_AREA)
+                cv2.rotate(rotated, rotateCode, dst=gray)
+            # Grey to RGB by broadcasting into the display buffer, only
+            # once the frame is down to screen size
+            displayBuffers[n][:] = gray[:, :, np.newaxis]
+        except Exception as e:
+            print(e)
+            continue
+        dispQ.put(n)
+        n = (n + 1) % len(displayBuffers)
 
 
 # Initialization -----------------------------------------------------------
-# Init framebuffer/touchscreen environment variables
-os.putenv('SDL_VIDEODRIVER', 'fbcon')
-os.putenv('SDL_FBDEV', '/dev/fb0')
+# Init framebuffer/touchscreen environment variables.  Set through
+# os.environ, which also calls putenv() but keeps Python's own copy in step.
+os.environ['SDL_VIDEODRIVER'] = 'fbcon'
+os.environ['SDL_FBDEV'] = '/dev/fb0'
 # !!!!!!!ATTENTION!!!!!!!!
 # When attached to an HDMI monitor, your TFT display will be /dev/fb1
 # When operating on its own, your TFT display will be /dev/fb0
 # To run in a desktop window, comment out the SDL_VIDEODRIVER and SDL_FBDEV settings
 # And disable fullscreen below
-# os.putenv('SDL_MOUSEDRV', 'TSLIB')
-# os.putenv('SDL_MOUSEDEV', '/dev/input/event3')
-os.putenv('SDL_NOMOUSE', '1')
+# os.environ['SDL_MOUSEDRV'] = 'TSLIB'
+# os.environ['SDL_MOUSEDEV'] = '/dev/input/event3'
+os.environ['SDL_NOMOUSE'] = '1'
 
 
 # Get user & group IDs for file & folder creation
-# (Want these to be 'pi' or other user, not root)
-s = os.getenv("SUDO_UID")
-uid = int(s) if s else os.getuid()
-s = os.getenv("SUDO_GID")
-gid = int(s) if s else os.getgid()
+# (Want these to be 'pi' or other user, not root).  SUDO_* only
+# matter when running as root; otherwise we already are that user.
+uid = os.getuid()
+gid = os.getgid()
+if os.geteuid() == 0:
+    uid = int(os.environ.get('SUDO_UID', uid))
+    gid = int(os.environ.get('SUDO_GID', gid))
 
 
 # Init camera and set up default values
@@ -858,6 +1435,12 @@ screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
 # Uncomment to run in a window on a desktop instead
 # screen = pygame.display.set_mode(res)
 pygame.mouse.set_visible(False)
+# Only queue the events the main loop acts on; motion, key-up, finger and
+# window events then never reach Python at all.  Blocked types can't be
+# posted either, so the spinner's own events have to be on the list.
+pygame.event.set_blocked(None)
+pygame.event.set_allowed([KEYDOWN, MOUSEBUTTONDOWN, SPINNER_EVENT,
+                          SPINNER_DONE])
 
 BACKGROUND = (0, 0, 0)
 TEXTCOLOUR = (255, 255, 255)
@@ -867,54 +1450,76 @@ textSufaceObj = fontObj.render('Loading assets', True, TEXTCOLOUR, None)
 screen.blit(textSufaceObj, (0, int(screen_height/2)))
 pygame.display.update()
 
-# Load all icons at startup.
-for file in os.listdir(iconPath):
-    if fnmatch.fnmatch(file, '*.png'):
-        icons.append(Icon(file.split('.')[0]))
+# Load all icons at startup (after set_mode, for convert_alpha).
+with os.scandir(iconPath) as it:
+    for entry in it:
+        if entry.name.endswith('.png'):
+            icons.append(Icon(entry.name[:-4]))
+iconByName = {i.name: i for i in icons}
 
 # Assign Icons to Buttons, now that they're loaded
 for s in buttons.values():        # For each screenful of buttons...
     for b in s:  # For each button on screen...
-        for i in icons:  # For each icon...
-            if b.bg == i.name:  # Compare names; match?
-                b.iconBg = i  # Assign Icon to Button
-                b.bg = None  # Name no longer used; allow garbage collection
-            if b.fg == i.name:
-                b.iconFg = i
-                b.fg = None
+        if b.bg in iconByName:  # Look up Icon by name; match?
+            b.iconBg = iconByName[b.bg]  # Assign Icon to Button
+            b.bg = None  # Name no longer used; allow garbage collection
+        if b.fg in iconByName:
+            b.iconFg = iconByName[b.fg]
+            b.fg = None
+        # Scale to the Button ahead of time, so drawing a screen is plain
+        # blits.  Icons swapped in later via setBg (radio buttons, labels,
+        # spinner) are scaled then, and cached by the Icon after that.
+        b._rescale()
 
 screen.fill(0)
-t = threading.Thread(target=spinner)
-t.start()
+startSpinner()
 
 # Set up Camera
 # Tuning file for the Raspberry Pi HQ Camera
 tuning = Picamera2.load_tuning_file("imx477.json")
 camera = Picamera2(tuning=tuning)
-main_config = {"size": sizeData[sizeMode][0]}
-lores_config = {"size": sizeData[sizeMode][1]}
-
-still_config = camera.create_still_configuration(main_config, lores_config)
-camera.configure(still_config)
-camera.still_configuration.enable_lores()
+camera.configure(videoConfig())
+camera.video_configuration.enable_lores()
 # Who knows why, but without setting the resolution here a second time I just get an empty screen
-camera.still_configuration.lores.size = sizeData[sizeMode][1]
-camera.still_configuration.align()
+camera.video_configuration.lores.size = sizeData[sizeMode][1]
+camera.video_configuration.align()
 camera.start()
-
-# I want my photos to be black and white and grainy. If you don't want that, remove these two lines
-# and also the CV2 COLOR_BGR2GRAY conversion
-camera.controls.Saturation = 0.0
-camera.controls.NoiseReductionMode = controls.draft.NoiseReductionModeEnum.Off
+sizeModeApplied = sizeMode
+# The lores size as actually configured (after align()), looked up once
+# rather than through request.config on every preview frame.  Reassigned
+# under cameraLock by applySizeMode, and captureWorker reads it under the
+# same lock.
+LORES_SIZE = tuple(camera.camera_config['lores']['size'])
+allocStillBuffer()
+
+# I want my photos to be black and white and grainy. If you don't want that, remove this call
+# and also switch the main stream back to BGR888 (the viewfinder only shows luma too, see captureWorker)
+setControls(Saturation=0.0,
+            NoiseReductionMode=controls.draft.NoiseReductionModeEnum.Off)
 setZoomMode(ZoomMode.NORMAL)
 
 # Set up buttons
 
 atexit.register(camera.stop)
 
+threading.Thread(target=captureWorker, daemon=True).start()
+threading.Thread(target=scaleWorker, daemon=True).start()
+threading.Thread(target=busyWorker, daemon=True).start()
+saveThread = threading.Thread(target=saveWorker, daemon=True)
+saveThread.start()
+
+
+def flushSaves():  # Don't lose shots still waiting to be written on exit
+    saveQueue.put(None)
+    saveThread.join()
+
+
+atexit.register(flushSaves)
+
 
 
 loadSettings()  # Must come last; fiddles with Button/Icon states
+applySizeMode()  # Reconfigure for the saved size, if it isn't the default
 
 screens = ['playback', 'delete_confirmation', '']
 
@@ -948,65 +1553,113 @@ controls = dict({
     Screen.QUIT: dict({pygame.K_RETURN: (quitCallback, None)}
                       )  # 9 is the quit screen
 })
+# The same tables in a list indexed by Screen.value, for the main loop:
+# hashing an Enum member runs Python code, indexing a list doesn't.
+# Pygame 2 key codes go far past 512 (arrow keys are 0x4000004F and up),
+# so the inner tables stay dicts.
+keyControls = [controls.get(Screen(i), {})
+               for i in range(max(m.value for m in Screen) + 1)]
+
+# Some keys have default meaning if not overwritten.  Folded into every
+# table up front, so a key press is a single lookup.
+for table in keyControls:
+    table.setdefault(K_DOWN, (settingCallback, -1))
+    table.setdefault(K_UP, (settingCallback, 1))
+    table.setdefault(K_z, (quitCallback, None))  # Always have a backup key to quit out of the program in development
+    table.setdefault(K_a, (doneCallback, None))  # Return to camera mode if shutter button is pressed
+
+
+# Redraw the background for one kind of screen, returning the dirty rects
+# (None if nothing under the buttons changed).  The main loop picks one by
+# screenMode.value from refreshers, rather than testing mode ranges.
+def refreshViewfinder():  # Viewfinder or settings modes
+    # Frames arrive already rotated and scaled to the screen; wait
+    # briefly for one so input keeps being processed meanwhile.
+    try:
+        n = dispQ.get(timeout=0.1)
+    except queue.Empty:
+        return None
+    if not pygame.display.get_init():
+        return None
+    screen.blit(displaySurfaces[n], (0, 0))
+    return [screen.get_rect()]
+
+
+def refreshPlayback():  # Playback mode or delete confirmation
+    img = scaled       # Show last-loaded image
+    screen.fill(0)
+    if (img):
+        fitBlit((0, 0, screen_width, screen_height), img, screen, True)
+    return [screen.get_rect()]
+
+
+def refreshNoImage():  # 'No Photos' mode
+    return None         # You get nothing, good day sir
+
+
+refreshers = [refreshPlayback if i < 2 else
+              refreshNoImage if i == 2 else
+              refreshViewfinder for i in range(len(keyControls))]
 
 # Main loop ----------------------------------------------------------------
-busy = False
-t.join()
+clock = pygame.time.Clock()
+stopSpinner()
 while (True):
-
-    # Process touchscreen input
-    while True:
-        for event in pygame.event.get():
-            if (event.type is KEYDOWN):
-                # Execute the appropriate function for this key in the controls
-                # array
-                callbackTuple = controls.get(screenMode).get(event.key, None)
-                if callbackTuple:
-                    if callbackTuple[1] is not None:
-                        callbackTuple[0](callbackTuple[1])
-                    else:
-                        callbackTuple[0]()
-            # Some keys have default meaning if not overwritten
-                if event.key == pygame.K_DOWN:
-                    settingCallback(-1)
-                elif event.key == pygame.K_UP:
-                    settingCallback(1)
-                elif event.key == pygame.K_z:  # Always have a backup key to quit out of the program in development
-                    quitCallback()
-                elif event.key == pygame.K_a:  # Return to camera mode if shutter button is pressed
-                    doneCallback()
-        # If in viewfinder or settings modes, stop processing touchscreen
-        # and refresh the display to show the live preview.  In other modes
-        # (image playback, etc.), stop and refresh the screen only when
-        # screenMode changes.
-        if screenMode.value >= 3 or screenMode != screenModePrior:
-            break
+    # The camera delivers about 30 fps, so there is nothing to gain from
+    # spinning any faster; this also idles playback modes between events.
+    clock.tick(30)
+
+    # Process touchscreen input, all queued events in one batch per frame.
+    # With no live preview and nothing to redraw, there is no reason to
+    # wake up at all until an event (tap, key, spinner timer) comes in.
+    if screenMode.value < 3 and screenMode == screenModePrior:
+        events = [pygame.event.wait()] + pygame.event.get()
+    else:
+        events = pygame.event.get()
+    for event in events:
+        eventType = event.type
+        if eventType == SPINNER_EVENT:
+            spinnerTick()
+        elif eventType == SPINNER_DONE:
+            stopSpinner()
+            if event.done:
+                event.done(event.result)
+        elif eventType == MOUSEBUTTONDOWN and not busy:
+            screenTapped(event.pos)
+        elif eventType == KEYDOWN and not busy:
+            # Execute the appropriate function for this key in the controls
+            # array.  Looked up per event, not once per batch: a callback
+            # may have just switched screens.
+            callbackTuple = keyControls[screenMode.value].get(event.key)
+            if callbackTuple:
+                if callbackTuple[1] is not None:
+                    callbackTuple[0](callbackTuple[1])
+                else:
+                    callbackTuple[0]()
+        # Apply a new size as soon as the event that left the size screen
+        # is done, before anything later in the batch (a shutter press,
+        # say) can start a capture on the old configuration
+        if screenMode != Screen.SETTINGS_SIZE:
+            applySizeMode()
+
+    # In viewfinder or settings modes, refresh the display every frame to
+    # show the live preview.  In other modes (image playback, etc.),
+    # refresh the screen only when screenMode changes.
+    if screenMode.value < 3 and screenMode == screenModePrior:
+        continue
 
     # Refresh display
-    if screenMode.value >= 3:  # Viewfinder or settings modes
-        yuv420 = camera.capture_array("lores")
-        rgb = cv2.cvtColor(yuv420, cv2.COLOR_YUV420p2BGR)
-        # The use of BGR here is intentional, for some reason the colours are wrong otherwise.
-
-        # Dimensions of the output buffer might not be the same as the input. Surprise!
-        h, w, d = rgb.shape
-        img = pygame.image.frombuffer(rgb, (w, h), 'RGB')
-        if pygame.display.get_init():
-            screen.fill(0)
-            img = pygame.transform.rotate(img, screen_rotation)
-            fillBlit((0, 0, screen_width, screen_height), img, screen, True)
-    elif screenMode.value < 2:  # Playback mode or delete confirmation
-        img = scaled       # Show last-loaded image
-        screen.fill(0)
-        if (img):
-            img = pygame.transform.rotate(img, screen_rotation)
-            fitBlit((0, 0, screen_width, screen_height), img, screen, True)
-    else:                # 'No Photos' mode
-        img = None         # You get nothing, good day sir
-
-    # Overlay buttons on display and update
-    for i, b in enumerate(buttons.get(screenMode)):
-        b.draw(screen)
-    pygame.display.update()
+    dirty = refreshers[screenMode.value]()  # Full-screen rect if redrawn
+
+    # No new preview frame arrived and the mode is unchanged: the screen
+    # already shows all there is, so skip the redraw and the push.  Button
+    # changes from settings callbacks go out with the next frame.
+    if dirty is None and screenMode == screenModePrior:
+        continue
+
+    # Overlay buttons on display and update.  If nothing under the
+    # buttons was redrawn, only the button rects need to be pushed.
+    rects = renderScreen(screen, screenMode)
+    pygame.display.update(dirty or rects)
 
     screenModePrior = screenMode
\ No newline at end of file